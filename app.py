@@ -1,18 +1,42 @@
-import pathlib
-import os
-
-import pandas as pd
 import numpy as np
-from urllib.request import urlopen
-import json
-import geopandas as gpd
+import pyarrow as pa
+import gzip
+import orjson
 
 
+import flask
+from flask_caching import Cache
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
+import plotly.utils
 import plotly.graph_objs as go
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
+
+
+class OrjsonEncoder(plotly.utils.PlotlyJSONEncoder):
+    """
+    PlotlyJSONEncoder that writes strict JSON with orjson in a single pass,
+    rather than dumping, re-loading and dumping again with the json module.
+    """
+
+    def encode(self, o):
+        return orjson.dumps(
+            o, default=self.default,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+        ).decode()
+
+
+# dash serialises the layout and every callback response with this encoder
+plotly.utils.PlotlyJSONEncoder = OrjsonEncoder
+
+
+def preserialize(obj):
+    """
+    Serialise an object that never changes once, responses then embed the
+    JSON as is instead of encoding it again.
+    """
+    return orjson.Fragment(OrjsonEncoder().encode(obj))
 
 amenities = ['hospital','supermarket','school','library']
 amenity_names = {'hospital':'Hospitals','school':'Schools','supermarket':'Supermarkets','library':'Libraries'}
@@ -29,20 +53,85 @@ app = dash.Dash(
     url_base_pathname='/proximity-baltimore/',
 )
 server = app.server
-app.config["suppress_callback_exceptions"] = True
+
+# ecdf figures for a selected range are cached by the exact amenity and range,
+# so the highlight always matches the range the map selects
+cache = Cache(server, config={'CACHE_TYPE': 'simple'})
 
 app.title = 'Evaluating proximity'
 
 # mapbox token
 mapbox_access_token = open(".mapbox_token").read()
 
-# Load data
-df_dist = pd.read_csv('./data/distance_to_nearest_md.csv',dtype={"geoid10": str})
-df_dist[amenities] = df_dist[amenities]/1000
+def read_arrow(path):
+    """
+    Memory-map an Arrow IPC file, its columns are then read without copying
+    or parsing.
+    """
+    return pa.ipc.open_file(pa.memory_map(path)).read_all()
 
-destinations = pd.read_csv('./data/destinations.csv')
 
-df_ecdf = pd.read_csv('./data/ecdf.csv')
+def arrow_column(table, name):
+    """
+    NumPy array of a column, a read-only view for numeric columns. The data
+    files are written as a single record batch, so each column is one chunk.
+    """
+    column = table.column(name)
+    if column.num_chunks != 1:
+        raise ValueError("column {} has {} chunks, rebuild the data with scripts/build_data.py".format(name, column.num_chunks))
+    return column.chunk(0).to_numpy(zero_copy_only=False)
+
+
+# Load data
+dist_table = read_arrow('./data/distance_to_nearest_md.arrow')
+population = arrow_column(dist_table, 'population')
+# metres to km, one multiply pass straight from the mapped buffer
+DIST_ARR = {a: np.multiply(arrow_column(dist_table, a), 0.001) for a in amenities}
+# integer block ids, matching the feature ids in block.geojson.gz
+LOC_IDS = arrow_column(dist_table, 'loc_id')
+# the map shows distances to 10 m, so only send them to that precision
+Z_BY_AMENITY = {a: np.round(DIST_ARR[a], 2).tolist() for a in amenities}
+
+# destinations are sorted by dest_type, so each amenity is a slice of the
+# float32 coordinates (ample for marker positions and shorter to serialise)
+dest_table = read_arrow('./data/destinations.arrow')
+dest_types = arrow_column(dest_table, 'dest_type')
+if (dest_types[1:] < dest_types[:-1]).any():
+    raise ValueError("destinations.arrow is not sorted by dest_type, rebuild it with scripts/build_data.py")
+dest_lat = arrow_column(dest_table, 'lat')
+dest_lon = arrow_column(dest_table, 'lon')
+DEST_BY_TYPE = {}
+for a, start, count in zip(*np.unique(dest_types, return_index=True, return_counts=True)):
+    DEST_BY_TYPE[a] = {'lat': dest_lat[start:start+count], 'lon': dest_lon[start:start+count]}
+
+# population weighted cdf and histogram of the distance to each amenity
+ECDF_BY_AMENITY = {}
+for a in amenities:
+    counts, cdf_x = np.histogram(DIST_ARR[a], bins=100, density=True, weights=population)
+    cdf_y = np.cumsum(counts)*(cdf_x[1] - cdf_x[0])*100
+    multiplier = 300 if a=='supermarket' else 150
+    counts, hist_x = np.histogram(DIST_ARR[a], bins=25, density=True, weights=population)
+    ECDF_BY_AMENITY[a] = (cdf_x, cdf_y, hist_x, counts*multiplier)
+
+# block geometry is stored gzipped and served as is to the map
+blocks_gz = open('./data/block.geojson.gz', 'rb').read()
+blocks_url = app.config.requests_pathname_prefix + 'data/block.geojson'
+
+
+@server.route(app.config.routes_pathname_prefix + 'data/block.geojson')
+def serve_blocks():
+    """
+    Serve the block geometry for the choropleth without re-reading or
+    re-compressing it.
+    """
+    if 'gzip' in flask.request.accept_encodings:
+        response = flask.Response(blocks_gz, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = flask.Response(gzip.decompress(blocks_gz), mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.add_etag()
+    return response.make_conditional(flask.request)
 
 
 # Assign color to legend
@@ -89,62 +178,60 @@ def brush(trace, points, state):
                                       # we have 0 at the position of unselected
                                       # points and 1 in the position of selected points
 
-def generate_ecdf_plot(amenity_select, dff_dist, x_range=None):
+# layout shared by the ecdf of every amenity, only the x axis title differs
+ECDF_LAYOUT = dict(
+    yaxis=dict(
+        title="% of residents".upper(),
+        range=(0,100),
+        fixedrange=True,
+        ),
+    font=dict(size=13),
+    dragmode="select",
+    paper_bgcolor = 'rgba(255,255,255,1)',
+    plot_bgcolor = 'rgba(0,0,0,0)',
+    bargap=0.05,
+    showlegend=False,
+    margin={'t': 10},
+    transition = {'duration': 500},
+)
+
+
+def generate_ecdf_plot(amenity_select, x_range=None):
     """
     :param amenity_select: the amenity of interest.
+    :param x_range: distance range to highlight.
     :return: Figure object
     """
     amenity = amenity_select
+    cdf_x, cdf_y, hist_x, hist_y = ECDF_BY_AMENITY[amenity]
     if x_range is None:
-        x_range = [dff_dist[amenity].min(), dff_dist[amenity].max()]
+        x_range = [hist_x[0], hist_x[-1]]
 
 
     layout = dict(
+        ECDF_LAYOUT,
         xaxis=dict(
             title="distance to nearest {} (km)".format(amenity).upper(),
             # range=(0,15),
             ),
-        yaxis=dict(
-            title="% of residents".upper(),
-            range=(0,100),
-            fixedrange=True,
-            ),
-        font=dict(size=13),
-        dragmode="select",
-        paper_bgcolor = 'rgba(255,255,255,1)',
-		plot_bgcolor = 'rgba(0,0,0,0)',
-        bargap=0.05,
-        showlegend=False,
-        margin={'t': 10},
-        transition = {'duration': 500},
-
     )
     data = []
     # add the cdf for that amenity
-    counts, bin_edges = np.histogram(dff_dist[amenity], bins=100, density = True, weights=dff_dist.population)
-    dx = bin_edges[1] - bin_edges[0]
     new_trace = go.Scatter(
-            x=bin_edges, y=np.cumsum(counts)*dx*100,
+            x=cdf_x, y=cdf_y,
             opacity=1,
             line=dict(color=colormap[amenity],),
-            text=np.repeat(amenity,len(dff_dist[amenity])),
+            text=amenity,
             hovertemplate = "%{y:.1f}% of residents live within %{x:.1f}km of a %{text} <br>" + "<extra></extra>",
             hoverlabel = dict(font_size=20),
             )
 
     data.append(new_trace)
 
-    # histogram
-    multiplier = 300 if amenity=='supermarket' else 150
-    counts, bin_edges = np.histogram(dff_dist[amenity], bins=25, density=True, weights=dff_dist.population)
-    opacity = []
-    for i in bin_edges:
-        if i >= x_range[0] and i <= x_range[1]:
-            opacity.append(0.6)
-        else:
-            opacity.append(0.1)
+    # histogram, highlighting the bins within the selected range
+    opacity = np.where((hist_x >= x_range[0]) & (hist_x <= x_range[1]), 0.6, 0.1)
     new_trace = go.Bar(
-            x=bin_edges, y=counts*multiplier,
+            x=hist_x, y=hist_y,
             marker_opacity=opacity,
             marker_color=colormap[amenity],
             hoverinfo="skip", hovertemplate="",)
@@ -155,61 +242,68 @@ def generate_ecdf_plot(amenity_select, dff_dist, x_range=None):
 
 
 
-def generate_map(amenity, dff_dest, x_range=None):
+# the ecdf without a selection, the only figure needed on an amenity change
+ECDF_FIGS = {a: preserialize(generate_ecdf_plot(a)) for a in amenities}
+
+
+@cache.memoize()
+def generate_ecdf_json(amenity_select, x_range):
+    """
+    :return: the ecdf figure for a selected range, serialised. A cache hit is
+    a plain string, rather than plotly objects to unpickle and re-encode.
+    """
+    return OrjsonEncoder().encode(generate_ecdf_plot(amenity_select, x_range))
+
+
+# map layout shared by every amenity, validated by plotly once
+MAP_LAYOUT = go.Layout(
+    clickmode="none",
+    dragmode="zoom",
+
+    showlegend=True,
+    autosize=True,
+    hovermode="closest",
+    margin=dict(l=0, r=0, t=0, b=0),
+    mapbox=go.layout.Mapbox(
+        accesstoken=mapbox_access_token,
+        bearing=0,
+        center=go.layout.mapbox.Center(lat = 39.292126, lon = -76.613632),
+        pitch=0,
+        zoom=10.5,
+        style="basic", #"dark", #
+    ),
+    legend=dict(
+        bgcolor="#1f2c56",
+        orientation="h",
+        font=dict(color="white"),
+        x=0,
+        y=0,
+        yanchor="bottom",
+    ),
+)
+
+
+def generate_map(amenity, dff_dest):
     """
     Generate map showing the distance to services and the locations of them
 
     :param amenity: the service of interest.
     :param dff_dest: the lat and lons of the service.
-    :param x_range: distance range to highlight.
     :return: Plotly figure object.
     """
 
-    layout = go.Layout(
-        clickmode="none",
-        dragmode="zoom",
-
-        showlegend=True,
-        autosize=True,
-        hovermode="closest",
-        margin=dict(l=0, r=0, t=0, b=0),
-        mapbox=go.layout.Mapbox(
-            accesstoken=mapbox_access_token,
-            bearing=0,
-            center=go.layout.mapbox.Center(lat = 39.292126, lon = -76.613632),
-            pitch=0,
-            zoom=10.5,
-            style="basic", #"dark", #
-        ),
-        legend=dict(
-            bgcolor="#1f2c56",
-            orientation="h",
-            font=dict(color="white"),
-            x=0,
-            y=0,
-            yanchor="bottom",
-        ),
-    )
-
-    if x_range:
-        # get the indices of the values within the specified range
-        idx = df_dist.index[df_dist[amenity].between(x_range[0],x_range[1], inclusive=True)].tolist()
-    else:
-        idx = df_dist.index.tolist()
-
     data = []
     # choropleth map showing the distance at the block level
     data.append(go.Choroplethmapbox(
-        geojson = 'https://raw.githubusercontent.com/urutau-nz/dash-evaluating-proximity/master/data/block.geojson',
-        locations = df_dist['geoid10'].tolist(),
-        z = df_dist[amenity].tolist(),
+        geojson = blocks_url,
+        locations = LOC_IDS,
+        z = Z_BY_AMENITY[amenity],
         colorscale = pl_deep,
         colorbar = dict(thickness=20, ticklen=3), zmin=0, zmax=5,
         marker_line_width=0, marker_opacity=0.7,
         visible=True,
         hovertemplate="Distance: %{z:.2f}km<br>" +
                         "<extra></extra>",
-        selectedpoints=idx,
     ))
 
     # scatterplot of the amenity locations
@@ -222,7 +316,30 @@ def generate_map(amenity, dff_dest, x_range=None):
         hoverinfo="skip", hovertemplate="",
     ))
 
-    return {"data": data, "layout": layout}
+    return {"data": data, "layout": MAP_LAYOUT}
+
+
+# build the map for each amenity once, assets/map.js patches it in the browser
+BASE_MAPS = {}
+for amenity in amenities:
+    fig = generate_map(amenity, DEST_BY_TYPE[amenity])
+    BASE_MAPS[amenity] = {
+        "data": [trace.to_plotly_json() for trace in fig["data"]],
+        "layout": fig["layout"].to_plotly_json(),
+    }
+
+
+# the parts of the map that change with the amenity
+MAP_PATCHES = {
+    a: preserialize({
+        "z": Z_BY_AMENITY[a],
+        "lat": DEST_BY_TYPE[a]["lat"],
+        "lon": DEST_BY_TYPE[a]["lon"],
+        "color": colormap[a],
+        "name": amenity_names[a],
+    })
+    for a in amenities
+}
 
 
 app.layout = html.Div(
@@ -272,14 +389,10 @@ app.layout = html.Div(
                             id="map-container",
                             children=[
                                 build_graph_title("Explore how far people need to travel"),
+                                dcc.Store(id="map-patch"),
                                 dcc.Graph(
                                     id="map",
-                                    figure={
-                                        "layout": {
-                                            "paper_bgcolor": "#192444",
-                                            "plot_bgcolor": "#192444",
-                                        }
-                                    },
+                                    figure=preserialize(BASE_MAPS[amenities[0]]),
                                     config={"scrollZoom": True, "displayModeBar": True,
                                             "modeBarButtonsToRemove":["lasso2d","select2d"],
                                     },
@@ -293,15 +406,7 @@ app.layout = html.Div(
                             children=[
                                 build_graph_title("Select a distance range"),
                                 dcc.Graph(id="ecdf",
-                                    figure={
-                                        "layout": {
-                                            'clickmode': 'event+select',
-                                            "paper_bgcolor": "#192444",
-                                            "plot_bgcolor": "#192444",
-                                            'mode': 'markers+lines',
-
-                                        }
-                                    },
+                                    figure=ECDF_FIGS[amenities[0]],
                                     config={"scrollZoom": True, "displayModeBar": True,
                                             "modeBarButtonsToRemove":['toggleSpikelines','hoverCompareCartesian'],
                                     },
@@ -329,40 +434,27 @@ app.layout = html.Div(
 )
 
 
-# Update access map
+# Send the parts of the map that change with the amenity
 @app.callback(
+    Output("map-patch", "data"),
+    [Input("amenity-select", "value")],
+    prevent_initial_call=True,
+)
+def update_map(amenity_select):
+    return MAP_PATCHES[amenity_select]
+
+
+# Apply the amenity patch and the selected distance range, in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace="map", function_name="updateMap"),
     Output("map", "figure"),
     [
-        Input("amenity-select", "value"),
-        # Input("ecdf", "relayoutData"),
         Input("ecdf", "selectedData"),
+        Input("map-patch", "data"),
     ],
+    [State("map", "figure")],
+    prevent_initial_call=True,
 )
-def update_map(
-    amenity_select, ecdf_selectedData
-):
-    x_range = None
-    # subset the desination df
-    dff_dest = destinations[destinations.dest_type == amenity_select]
-
-    # Find which one has been triggered
-    ctx = dash.callback_context
-
-    prop_id = ""
-    prop_type = ""
-    if ctx.triggered:
-        splitted = ctx.triggered[0]["prop_id"].split(".")
-        prop_id = splitted[0]
-        prop_type = splitted[1]
-
-    if prop_id == 'ecdf' and prop_type == "selectedData":
-        if ecdf_selectedData:
-            if 'range' in ecdf_selectedData:
-                x_range = ecdf_selectedData['range']['x']
-            else:
-                x_range = [ecdf_selectedData['points'][0]['x']]*2
-
-    return generate_map(amenity_select, dff_dest, x_range=x_range)
 
 
 # Update ecdf
@@ -372,6 +464,7 @@ def update_map(
         Input("amenity-select", "value"),
         Input("ecdf", "selectedData"),
     ],
+    prevent_initial_call=True,
 )
 def update_ecdf(
     amenity_select, ecdf_selectedData
@@ -379,9 +472,6 @@ def update_ecdf(
     x_range = None
     # day = int(day)
 
-    # subset data
-    dff_dist = df_dist#[df_dist['service']==amenity_select]
-
     # Find which one has been triggered
     ctx = dash.callback_context
 
@@ -399,7 +489,9 @@ def update_ecdf(
             else:
                 x_range = [ecdf_selectedData['points'][0]['x']]*2
 
-    return generate_ecdf_plot(amenity_select, dff_dist, x_range)
+    if x_range is None:
+        return ECDF_FIGS[amenity_select]
+    return orjson.Fragment(generate_ecdf_json(amenity_select, x_range))
 
 
 # Running the server
@@ -0,0 +1,79 @@
+(function() {
+    // amenity patch last applied, to tell an amenity change from a new selection
+    var lastPatch = null;
+    // block indices sorted by distance and the sorted distances, for the current z
+    var order = null;
+    var sortedZ = null;
+
+    window.dash_clientside = window.dash_clientside || {};
+    window.dash_clientside.map = {
+        // apply the amenity patch from the server, then highlight the blocks
+        // within the distance range selected on the ecdf. Until the amenity
+        // first changes there is no patch and the figure from the layout is used.
+        updateMap: function(selectedData, patch, figure) {
+            if (!figure || !figure.data) {
+                return window.dash_clientside.no_update;
+            }
+            var choropleth = figure.data[0];
+            var scatter = figure.data[1];
+
+            // a new amenity starts without a selection
+            if (patch !== lastPatch) {
+                lastPatch = patch;
+                order = sortedZ = null;
+                choropleth = Object.assign({}, choropleth, {z: patch.z, selectedpoints: null});
+                scatter = Object.assign({}, scatter, {
+                    lat: patch.lat,
+                    lon: patch.lon,
+                    name: patch.name,
+                    marker: Object.assign({}, scatter.marker, {color: patch.color}),
+                });
+            } else {
+                choropleth = Object.assign({}, choropleth, {
+                    selectedpoints: selectBlocks(selectedData, choropleth.z),
+                });
+            }
+
+            // copy rather than mutate the figure held by the graph
+            return Object.assign({}, figure, {data: [choropleth, scatter]});
+        }
+    };
+
+    // indices of the blocks within the selected range, or null for no selection
+    function selectBlocks(selectedData, z) {
+        var lo, hi;
+        if (!selectedData) {
+            return null;
+        } else if (selectedData.range) {
+            lo = selectedData.range.x[0];
+            hi = selectedData.range.x[1];
+        } else if (selectedData.points && selectedData.points.length) {
+            lo = hi = selectedData.points[0].x;
+        } else {
+            return null;
+        }
+
+        // sort once per amenity, then each selection is two binary searches
+        if (!order) {
+            order = z.map(function(v, i) { return i; });
+            order.sort(function(a, b) { return z[a] - z[b]; });
+            sortedZ = order.map(function(i) { return z[i]; });
+        }
+        return order.slice(bisect(sortedZ, lo, false), bisect(sortedZ, hi, true));
+    }
+
+    // index of the first sorted value >= x, or > x when right is set
+    function bisect(values, x, right) {
+        var lo = 0;
+        var hi = values.length;
+        while (lo < hi) {
+            var mid = (lo + hi) >> 1;
+            if (values[mid] < x || (right && values[mid] === x)) {
+                lo = mid + 1;
+            } else {
+                hi = mid;
+            }
+        }
+        return lo;
+    }
+})();
@@ -0,0 +1,170 @@
+"""
+Build the data files the app loads from the source data in data/
+
+    python scripts/build_data.py
+
+distance_to_nearest_md.csv -> distance_to_nearest_md.arrow
+    adds loc_id, the integer id of each block (its row position)
+destinations.csv -> destinations.arrow
+    sorted by dest_type so each amenity is a contiguous slice,
+    lat/lon stored as float32
+block.geojson -> block.geojson.gz
+    feature ids replaced by loc_id, polygons simplified along the edges
+    neighbouring blocks share and coordinates rounded, minified and gzipped
+    for the app to serve as is
+"""
+import argparse
+import gzip
+import json
+import pathlib
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from shapely.geometry import LineString, shape
+
+DATA = pathlib.Path(__file__).resolve().parent.parent / 'data'
+
+# simplification tolerance in degrees, edges move by at most ~5 m, within the
+# width of a street when zoomed in; and decimals kept in the coordinates, ~1 m
+TOLERANCE = 5e-5
+DECIMALS = 5
+
+
+def write_arrow(df, path):
+    """
+    Write a dataframe as an uncompressed Arrow IPC file with a single record
+    batch, so the app can memory-map it and view each column without copying.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.RecordBatchFileWriter(str(path), table.schema) as writer:
+        writer.write_table(table)
+
+
+def build_distances():
+    """
+    :return: the distance table, with loc_id added.
+    """
+    df_dist = pd.read_csv(DATA / 'distance_to_nearest_md.csv', dtype={"geoid10": str})
+    df_dist.insert(1, 'loc_id', np.arange(len(df_dist), dtype=np.int64))
+    write_arrow(df_dist, DATA / 'distance_to_nearest_md.arrow')
+    return df_dist
+
+
+def build_destinations():
+    destinations = pd.read_csv(DATA / 'destinations.csv')
+    destinations = destinations.sort_values('dest_type', kind='mergesort').reset_index(drop=True)
+    destinations[['lat', 'lon']] = destinations[['lat', 'lon']].astype(np.float32)
+    write_arrow(destinations, DATA / 'destinations.arrow')
+
+
+def find_junctions(rings):
+    """
+    Vertices where neighbouring rings meet or part. A vertex on a single ring,
+    or inside an edge shared by two blocks, has exactly two neighbours.
+    """
+    neighbours = defaultdict(set)
+    for ring in rings:
+        for prev, point, nxt in zip(ring[-2:-1] + ring[:-2], ring[:-1], ring[1:]):
+            neighbours[point].update((prev, nxt))
+    return {point for point, n in neighbours.items() if len(n) > 2}
+
+
+def split_ring(ring, junctions):
+    """
+    Split a closed ring into arcs that start and end at junctions.
+    """
+    points = ring[:-1]
+    cuts = [i for i, point in enumerate(points) if point in junctions]
+    if not cuts:
+        # a ring meeting no other, e.g. a block inside another, starts at its
+        # smallest vertex so both copies of it split the same way
+        cuts = [points.index(min(points))]
+    points = points[cuts[0]:] + points[:cuts[0]+1]
+    cuts = [i - cuts[0] for i in cuts] + [len(points) - 1]
+    return [tuple(points[a:b+1]) for a, b in zip(cuts, cuts[1:])]
+
+
+def simplify_blocks(features, tolerance, decimals):
+    """
+    Simplify the block outlines along the arcs between junctions, each arc
+    once, so neighbouring blocks keep sharing their edges with no gaps or
+    overlaps. Arcs of a block that would become invalid are kept as they are.
+
+    :return: the simplified, rounded coordinates of each feature, as MultiPolygons.
+    """
+    polygons = []
+    for feature in features:
+        geom = feature['geometry']
+        coords = geom['coordinates'] if geom['type'] == 'MultiPolygon' else [geom['coordinates']]
+        polygons.append([[[tuple(point) for point in ring] for ring in polygon] for polygon in coords])
+    junctions = find_junctions([ring for feature in polygons for polygon in feature for ring in polygon])
+    arcs = [[[split_ring(ring, junctions) for ring in polygon] for polygon in feature] for feature in polygons]
+
+    lines = {}
+    keep = set()
+    while True:
+        result = []
+        kept = len(keep)
+        for feature in arcs:
+            coords = []
+            for polygon in feature:
+                rings = []
+                for ring_arcs in polygon:
+                    ring = []
+                    for arc in ring_arcs:
+                        # each arc is simplified and rounded once, in one direction
+                        key = min(arc, arc[::-1])
+                        if key not in lines:
+                            line = key
+                            if tolerance and key not in keep:
+                                line = LineString(key).simplify(tolerance, preserve_topology=False).coords
+                            line = [(round(x, decimals), round(y, decimals)) for x, y in line]
+                            lines[key] = [point for i, point in enumerate(line) if i == 0 or point != line[i-1]]
+                        line = lines[key] if key == arc else lines[key][::-1]
+                        ring.extend(line[1:] if ring else line)
+                    rings.append(ring)
+                coords.append(rings)
+            # check the block as it will be written, after rounding
+            if not all(len(ring) >= 4 for polygon in coords for ring in polygon) \
+                    or not shape({'type': 'MultiPolygon', 'coordinates': coords}).is_valid:
+                for key in {min(arc, arc[::-1]) for polygon in feature for ring_arcs in polygon for arc in ring_arcs}:
+                    if key not in keep:
+                        keep.add(key)
+                        del lines[key]
+            result.append(coords)
+        if len(keep) == kept:
+            return result
+
+
+def build_blocks(df_dist, tolerance=TOLERANCE, decimals=DECIMALS):
+    """
+    :param df_dist: the distance table, mapping geoid10 to loc_id.
+    :param tolerance: Douglas-Peucker tolerance in degrees, 0 to keep every vertex.
+    :param decimals: decimals kept in the coordinates.
+    """
+    loc_ids = dict(zip(df_dist['geoid10'], df_dist['loc_id'].tolist()))
+    blocks = json.loads((DATA / 'block.geojson').read_text())
+    coords = simplify_blocks(blocks['features'], tolerance, decimals)
+    for feature, polygons in zip(blocks['features'], coords):
+        feature['id'] = loc_ids[feature['id']]
+        feature['geometry'] = {'type': 'MultiPolygon', 'coordinates': polygons}
+
+    raw = json.dumps(blocks, separators=(',', ':')).encode()
+    # fixed mtime so rebuilding unchanged data gives an identical file
+    with gzip.GzipFile(DATA / 'block.geojson.gz', 'wb', compresslevel=9, mtime=0) as f:
+        f.write(raw)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='polygon simplification tolerance in degrees, 0 to disable')
+    parser.add_argument('--decimals', type=int, default=DECIMALS,
+                        help='decimals kept in the block coordinates')
+    args = parser.parse_args()
+
+    df_dist = build_distances()
+    build_destinations()
+    build_blocks(df_dist, args.tolerance, args.decimals)